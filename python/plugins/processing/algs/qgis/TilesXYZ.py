@@ -21,14 +21,14 @@ __copyright__ = '(C) 2019 by Lutra Consulting Limited'
 
 import os
 import math
-import re
-from typing import List, Tuple
+import queue
+from typing import Dict, Iterable, List, Optional, Tuple
 import urllib.parse
-from uuid import uuid4
 
 import sqlite3
 from osgeo import gdal
-from qgis.PyQt.QtCore import QSize, Qt, QByteArray, QBuffer
+from qgis.PyQt import sip
+from qgis.PyQt.QtCore import QSize, Qt, QByteArray, QBuffer, QIODevice
 from qgis.PyQt.QtGui import QColor, QImage, QPainter
 from qgis.core import (QgsProcessingException,
                        QgsProcessingParameterEnum,
@@ -53,69 +53,78 @@ from qgis.core import (QgsProcessingException,
                        QgsProcessingAlgorithm)
 from processing.algs.qgis.QgisAlgorithm import QgisAlgorithm
 import threading
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
 from processing.core.ProcessingConfig import ProcessingConfig
 
 
+MAX_PENDING_METATILES = 64  # metatiles submitted to the thread pool at once, per thread
+MERCATOR_HALF_WIDTH = math.pi * 6378137.0  # half of the EPSG:3857 world width in meters
+
+
 # TMS functions taken from https://alastaira.wordpress.com/2011/07/06/converting-tms-tile-coordinates-to-googlebingosm-tile-coordinates/ #spellok
 def tms(ytile: float, zoom: int) -> int:
-    n = 2.0 ** zoom
-    ytile = n - ytile - 1
-    return int(ytile)
+    return (1 << zoom) - int(ytile) - 1
 
 
 # Math functions taken from https://wiki.openstreetmap.org/wiki/Slippy_map_tilenames #spellok
-def deg2num(lat_deg: float, lon_deg: float, zoom: int) -> Tuple[int, int]:
+def deg2frac(lat_deg: float, lon_deg: float) -> Tuple[float, float]:
+    """
+    Returns the position of the point as a fraction of the world width and height, independent of the zoom level.
+    """
     lat_rad = math.radians(lat_deg)
-    n = 2.0 ** zoom
-    xtile = int((lon_deg + 180.0) / 360.0 * n)
-    ytile = int((1.0 - math.log(math.tan(lat_rad) + (1 / math.cos(lat_rad))) / math.pi) / 2.0 * n)
-    return (xtile, ytile)
+    x_frac = (lon_deg + 180.0) / 360.0
+    y_frac = (1.0 - math.log(math.tan(lat_rad) + (1 / math.cos(lat_rad))) / math.pi) / 2.0
+    return (x_frac, y_frac)
 
 
-# Math functions taken from https://wiki.openstreetmap.org/wiki/Slippy_map_tilenames #spellok
-def num2deg(xtile: int, ytile: int, zoom: int) -> Tuple[float, float]:
-    n = 2.0 ** zoom
-    lon_deg = xtile / n * 360.0 - 180.0
-    lat_rad = math.atan(math.sinh(math.pi * (1 - 2 * ytile / n)))
-    lat_deg = math.degrees(lat_rad)
-    return (lat_deg, lon_deg)
+def deg2num(lat_deg: float, lon_deg: float, zoom: int) -> Tuple[int, int]:
+    x_frac, y_frac = deg2frac(lat_deg, lon_deg)
+    n = float(1 << zoom)
+    return (int(x_frac * n), int(y_frac * n))
+
+
+# Tile corners in Web Mercator (EPSG:3857) are a linear function of the tile indices
+def num2merc(xtile: int, ytile: int, zoom: int) -> Tuple[float, float]:
+    tile_size = 2 * MERCATOR_HALF_WIDTH / (1 << zoom)
+    x = xtile * tile_size - MERCATOR_HALF_WIDTH
+    y = MERCATOR_HALF_WIDTH - ytile * tile_size
+    return (x, y)
 
 
 class Tile:
+    __slots__ = ('x', 'y', 'z')
 
     def __init__(self, x: int, y: int, z: int):
         self.x = x
         self.y = y
         self.z = z
 
-    def extent(self):
-        lat1, lon1 = num2deg(self.x, self.y, self.z)
-        lat2, lon2 = num2deg(self.x + 1, self.y + 1, self.z)
-        return [lon1, lat2, lon2, lat1]
-
 
 class MetaTile:
+    __slots__ = ('tiles', '_max_row', '_max_col', '_mercator_extent')
 
-    def __init__(self):
+    def __init__(self, mercator_extent: List[float]):
         # list of tuple(row index, column index, Tile)
         self.tiles: List[Tuple[int, int, Tile]] = []
+        self._max_row = -1
+        self._max_col = -1
+        self._mercator_extent = mercator_extent
 
     def add_tile(self, row: int, column: int, tile: Tile):
         self.tiles.append((row, column, tile))
+        if row > self._max_row:
+            self._max_row = row
+        if column > self._max_col:
+            self._max_col = column
 
     def rows(self) -> int:
-        return max([r for r, _, _ in self.tiles]) + 1
+        return self._max_row + 1
 
     def columns(self) -> int:
-        return max([c for _, c, _ in self.tiles]) + 1
+        return self._max_col + 1
 
-    def extent(self):
-        _, _, first = self.tiles[0]
-        _, _, last = self.tiles[-1]
-        lat1, lon1 = num2deg(first.x, first.y, first.z)
-        lat2, lon2 = num2deg(last.x + 1, last.y + 1, first.z)
-        return [lon1, lat2, lon2, lat1]
+    def mercator_extent(self) -> List[float]:
+        return self._mercator_extent
 
 
 def get_tile_based_extent(extent: Tuple[float, float, float, float], zoom: int) -> Tuple[int, int, int, int]:
@@ -125,28 +134,53 @@ def get_tile_based_extent(extent: Tuple[float, float, float, float], zoom: int)
     return left_tile, top_tile, right_tile, bottom_tile
 
 
-def get_metatiles(extent: Tuple[float, float, float, float], zoom: int, size=4):
-    left_tile, top_tile, right_tile, bottom_tile = get_tile_based_extent(extent, zoom)
-
-    meta_row_max = int((bottom_tile - top_tile) / size) + 1
-    meta_col_max = int((right_tile - left_tile) / size) + 1
-    for meta_col in range(meta_col_max):
-        for meta_row in range(meta_row_max):
-            metatile = MetaTile()
-            for i in range(size):
-                for j in range(size):
-                    x = left_tile + meta_col * size + i
-                    y = top_tile + meta_row * size + j
-                    if x <= right_tile and y <= bottom_tile:
-                        metatile.add_tile(i, j, Tile(x, y, zoom))
+def get_tile_based_extent_multi(extent: Tuple[float, float, float, float],
+                                zooms: Iterable[int]) -> Dict[int, Tuple[int, int, int, int]]:
+    """
+    Returns the tile based extent for each of the zoom levels, the same as calling get_tile_based_extent
+    for every zoom level, but deg2frac is only evaluated once per edge.
+    """
+    west_edge, south_edge, east_edge, north_edge = extent
+    # fractions of the world width/height, only scaled per zoom (as in deg2num)
+    west_frac, north_frac = deg2frac(north_edge, west_edge)
+    east_frac, south_frac = deg2frac(south_edge, east_edge)
+
+    tile_extents = {}
+    for zoom in zooms:
+        n = float(1 << zoom)
+        tile_extents[zoom] = (int(west_frac * n), int(north_frac * n), int(east_frac * n), int(south_frac * n))
+    return tile_extents
+
+
+def get_metatiles(extent: Tuple[float, float, float, float], zoom: int, size=4,
+                  tile_extent: Optional[Tuple[int, int, int, int]] = None):
+    left_tile, top_tile, right_tile, bottom_tile = tile_extent or get_tile_based_extent(extent, zoom)
+
+    # tile indices are only computed once per zoom, metatiles take slices of them
+    xs = range(left_tile, right_tile + 1)
+    ys = range(top_tile, bottom_tile + 1)
+    # metatile edges in EPSG:3857, each one is shared by the neighbouring metatiles
+    x_edges = [num2merc(x, 0, zoom)[0] for x in xs[::size]] + [num2merc(right_tile + 1, 0, zoom)[0]]
+    y_edges = [num2merc(0, y, zoom)[1] for y in ys[::size]] + [num2merc(0, bottom_tile + 1, zoom)[1]]
+    for col_index, meta_col in enumerate(range(0, len(xs), size)):
+        meta_xs = xs[meta_col:meta_col + size]
+        for row_index, meta_row in enumerate(range(0, len(ys), size)):
+            meta_ys = ys[meta_row:meta_row + size]
+            metatile = MetaTile([x_edges[col_index], y_edges[row_index + 1],
+                                 x_edges[col_index + 1], y_edges[row_index]])
+            for i, x in enumerate(meta_xs):
+                for j, y in enumerate(meta_ys):
+                    metatile.add_tile(i, j, Tile(x, y, zoom))
             yield metatile
 
 
-def get_metatiles_count(extent: Tuple[float, float, float, float], zoom: int, size=4) -> int:
-    left_tile, top_tile, right_tile, bottom_tile = get_tile_based_extent(extent, zoom)
+def get_metatiles_count(extent: Tuple[float, float, float, float], zoom: int, size=4,
+                        tile_extent: Optional[Tuple[int, int, int, int]] = None) -> int:
+    left_tile, top_tile, right_tile, bottom_tile = tile_extent or get_tile_based_extent(extent, zoom)
 
-    meta_row_max = int((bottom_tile - top_tile) / size) + 1
-    meta_col_max = int((right_tile - left_tile) / size) + 1
+    # ceiling division of the number of tiles, matching the metatiles yielded by get_metatiles
+    meta_row_max = max(0, (bottom_tile - top_tile + size) // size)
+    meta_col_max = max(0, (right_tile - left_tile + size) // size)
     return meta_row_max * meta_col_max
 
 
@@ -200,7 +234,6 @@ class TilesXYZAlgorithmBase(QgisAlgorithm):
                                                        minValue=1,
                                                        maxValue=20,
                                                        defaultValue=4))
-        self.thread_nr_re = re.compile('[0-9]+$')  # thread number regex
 
     def prepareAlgorithm(self, parameters, context, feedback):
         project = context.project()
@@ -208,32 +241,37 @@ class TilesXYZAlgorithmBase(QgisAlgorithm):
         self.layers = [l for l in project.layerTreeRoot().layerOrder() if l in visible_layers]
         return True
 
+    def threadMapSettings(self) -> QgsMapSettings:
+        """
+        Returns the map settings of the current thread, a copy of the prototype settings made on first use.
+        """
+        settings = getattr(self.threadLocalData, 'settings', None)
+        if settings is None:
+            settings = QgsMapSettings(self.mapSettings)
+            self.threadLocalData.settings = settings
+        return settings
+
     def renderSingleMetatile(self, metatile: MetaTile):
-        if self.feedback.isCanceled():
+        if self.feedback.isCanceled() or self.writerError is not None:
             return
             # Haven't found a better way to break than to make all the new threads return instantly
 
-        if "Dummy" in threading.current_thread().name or len(self.settingsDictionary) == 1:  # single thread testing
-            threadSpecificSettings = list(self.settingsDictionary.values())[0]
-        else:
-            thread_nr = self.thread_nr_re.search(threading.current_thread().name)[0]  # terminating number only
-            threadSpecificSettings = self.settingsDictionary[thread_nr]
+        threadSpecificSettings = self.threadMapSettings()
 
         size = QSize(self.tile_width * metatile.rows(), self.tile_height * metatile.columns())
-        extent = QgsRectangle(*metatile.extent())
-        threadSpecificSettings.setExtent(self.wgs_to_dest.transformBoundingBox(extent))
+        # the destination CRS is always EPSG:3857, so the extent is computed directly from the tile indices
+        threadSpecificSettings.setExtent(QgsRectangle(*metatile.mercator_extent()))
         threadSpecificSettings.setOutputSize(size)
 
-        # Append MapSettings scope in order to update map variables (e.g @map_scale) with new extent data
-        exp_context = threadSpecificSettings.expressionContext()
+        # Append MapSettings scope in order to update map variables (e.g @map_scale) with new extent data,
+        # starting from the prototype context so that the scopes of previous metatiles don't pile up
+        exp_context = self.mapSettings.expressionContext()
         exp_context.appendScope(QgsExpressionContextUtils.mapSettingsScope(threadSpecificSettings))
         threadSpecificSettings.setExpressionContext(exp_context)
 
-        image = QImage(size, QImage.Format_ARGB32_Premultiplied)
-        image.fill(self.color)
         dpm = round(threadSpecificSettings.outputDpi() / 25.4 * 1000)
-        image.setDotsPerMeterX(dpm)
-        image.setDotsPerMeterY(dpm)
+        image = self.takeMetatileImage(size, dpm)
+        image.fill(self.color)
         painter = QPainter(image)
         job = QgsMapRendererCustomPainterJob(threadSpecificSettings, painter)
         job.renderSynchronously()
@@ -244,15 +282,74 @@ class TilesXYZAlgorithmBase(QgisAlgorithm):
         # os.makedirs(metatile_dir, exist_ok=True)
         # image.save(os.path.join(metatile_dir, 'metatile_%s.png' % i))
 
+        # tiles are views into the metatile image rather than copies of it
+        bits = int(image.constBits())
+        bytes_per_line = image.bytesPerLine()
+        bytes_per_pixel = image.depth() // 8
+        tiles = []
         for r, c, tile in metatile.tiles:
-            tileImage = image.copy(self.tile_width * r, self.tile_height * c, self.tile_width, self.tile_height)
-            self.writer.write_tile(tile, tileImage)
+            offset = self.tile_height * c * bytes_per_line + self.tile_width * r * bytes_per_pixel
+            tileImage = QImage(sip.voidptr(bits + offset), self.tile_width, self.tile_height, bytes_per_line, image.format())
+            tileImage.setDotsPerMeterX(dpm)
+            tileImage.setDotsPerMeterY(dpm)
+            tiles.append((tile, tileImage))
+
+        if self.tileQueue is None:
+            for tile, tileImage in tiles:
+                self.writer.write_tile(tile, tileImage)
+            self.releaseMetatileImage(image)
+        else:
+            # encoding and writing is left to the writer threads, the metatile image keeps the tile views valid
+            self.tileQueue.put((image, tiles))
 
         # to stop thread sync issues
         with self.progressThreadLock:
             self.progress += 1
-            self.feedback.setProgress(100 * (self.progress / self.totalMetatiles))
-            self.feedback.setProgressText(self.tr('Generated: {progress}/{total} metatiles').format(progress=self.progress, total=self.totalMetatiles))
+            # feedback is only updated every progressInterval metatiles
+            if self.progress % self.progressInterval == 0 or self.progress == self.totalMetatiles:
+                self.feedback.setProgress(100 * (self.progress / self.totalMetatiles))
+                self.feedback.setProgressText(self.progressText.format(progress=self.progress, total=self.totalMetatiles))
+
+    def writeQueuedTiles(self):
+        while True:
+            item = self.tileQueue.get()
+            if item is None:
+                return
+            if self.writerError is not None:
+                # keep draining the queue so that rendering threads never block on it
+                continue
+            image, tiles = item
+            try:
+                for tile, tileImage in tiles:
+                    self.writer.write_tile(tile, tileImage)
+            except Exception as e:
+                self.writerError = e
+            else:
+                self.releaseMetatileImage(image)
+
+    def takeMetatileImage(self, size: QSize, dpm: int) -> QImage:
+        """
+        Returns an image for rendering a metatile, recycling images whose tiles have already been written.
+        """
+        try:
+            image = self.freeImages.get_nowait()
+        except queue.Empty:
+            image = None
+        # images of a different size (partial metatiles at the extent edge) are dropped
+        if image is None or image.size() != size:
+            image = QImage(size, QImage.Format_ARGB32_Premultiplied)
+            image.setDotsPerMeterX(dpm)
+            image.setDotsPerMeterY(dpm)
+        return image
+
+    def releaseMetatileImage(self, image: QImage):
+        """
+        Makes the image available for rendering another metatile, once no tile refers to it anymore.
+        """
+        try:
+            self.freeImages.put_nowait(image)
+        except queue.Full:
+            pass
 
     def generate(self, writer, parameters, context, feedback):
         self.feedback = feedback
@@ -286,40 +383,36 @@ class TilesXYZAlgorithmBase(QgisAlgorithm):
         dest_crs = QgsCoordinateReferenceSystem('EPSG:3857')
 
         self.src_to_wgs = QgsCoordinateTransform(project.crs(), wgs_crs, context.transformContext())
-        self.wgs_to_dest = QgsCoordinateTransform(wgs_crs, dest_crs, context.transformContext())
-        # without re-writing, we need a different settings for each thread to stop async errors
-        # naming doesn't always line up, but the last number does
-        self.settingsDictionary = {str(i): QgsMapSettings() for i in range(self.maxThreads)}
-        for thread in self.settingsDictionary:
-            self.settingsDictionary[thread].setOutputImageFormat(QImage.Format_ARGB32_Premultiplied)
-            self.settingsDictionary[thread].setTransformContext(context.transformContext())
-            self.settingsDictionary[thread].setDestinationCrs(dest_crs)
-            self.settingsDictionary[thread].setLayers(self.layers)
-            self.settingsDictionary[thread].setOutputDpi(dpi)
-            if self.tile_format == 'PNG':
-                self.settingsDictionary[thread].setBackgroundColor(self.color)
-            self.settingsDictionary[thread].setFlag(QgsMapSettings.Antialiasing, self.antialias)
-
-            # disable partial labels (they would be cut at the edge of tiles)
-            labeling_engine_settings = self.settingsDictionary[thread].labelingEngineSettings()
-            labeling_engine_settings.setFlag(QgsLabelingEngineSettings.UsePartialCandidates, False)
-            self.settingsDictionary[thread].setLabelingEngineSettings(labeling_engine_settings)
-
-            # Transfer context scopes to MapSettings
-            self.settingsDictionary[thread].setExpressionContext(context.expressionContext())
+        # prototype of the map settings, every rendering thread works on its own copy (see threadMapSettings)
+        self.mapSettings = QgsMapSettings()
+        self.mapSettings.setOutputImageFormat(QImage.Format_ARGB32_Premultiplied)
+        self.mapSettings.setTransformContext(context.transformContext())
+        self.mapSettings.setDestinationCrs(dest_crs)
+        self.mapSettings.setLayers(self.layers)
+        self.mapSettings.setOutputDpi(dpi)
+        if self.tile_format == 'PNG':
+            self.mapSettings.setBackgroundColor(self.color)
+        self.mapSettings.setFlag(QgsMapSettings.Antialiasing, self.antialias)
+
+        # disable partial labels (they would be cut at the edge of tiles)
+        labeling_engine_settings = self.mapSettings.labelingEngineSettings()
+        labeling_engine_settings.setFlag(QgsLabelingEngineSettings.UsePartialCandidates, False)
+        self.mapSettings.setLabelingEngineSettings(labeling_engine_settings)
+
+        # Transfer context scopes to MapSettings
+        self.mapSettings.setExpressionContext(context.expressionContext())
 
         self.wgs_extent = self.src_to_wgs.transformBoundingBox(extent)
         self.wgs_extent = [self.wgs_extent.xMinimum(), self.wgs_extent.yMinimum(), self.wgs_extent.xMaximum(),
                            self.wgs_extent.yMaximum()]
 
-        metatiles_by_zoom = {}
-        self.totalMetatiles = 0
-        for zoom in range(self.min_zoom, self.max_zoom + 1):
-            metatiles = get_metatiles(self.wgs_extent, zoom, self.metatilesize)
-            metatiles_by_zoom[zoom] = metatiles
-            self.totalMetatiles += get_metatiles_count(self.wgs_extent, zoom, self.metatilesize)
+        self.tile_extents = get_tile_based_extent_multi(self.wgs_extent, range(self.min_zoom, self.max_zoom + 1))
+        self.totalMetatiles = sum(get_metatiles_count(self.wgs_extent, zoom, self.metatilesize, tile_extent)
+                                  for zoom, tile_extent in self.tile_extents.items())
 
         self.progress = 0
+        self.progressInterval = max(1, self.totalMetatiles // 200)
+        self.progressText = self.tr('Generated: {progress}/{total} metatiles')
 
         tile_params = {
             'format': self.tile_format,
@@ -332,25 +425,73 @@ class TilesXYZAlgorithmBase(QgisAlgorithm):
         }
         writer.set_parameters(tile_params)
         self.writer = writer
+        try:
+            self.renderMetatiles(feedback)
+        finally:
+            writer.close()
 
+    def renderMetatiles(self, feedback):
         self.progressThreadLock = threading.Lock()
+        self.threadLocalData = threading.local()
+        # rendering threads, queued metatiles and writer threads each hold at most one image
+        self.freeImages = queue.LifoQueue(maxsize=4 * self.maxThreads)
+        self.tileQueue = None
+        self.writerError = None
         if self.maxThreads > 1:
             feedback.pushConsoleInfo(self.tr('Using {max_threads} CPU Threads:').format(max_threads=self.maxThreads))
-            for zoom in range(self.min_zoom, self.max_zoom + 1):
-                feedback.pushConsoleInfo(self.tr('Generating tiles for zoom level: {zoom}').format(zoom=zoom))
+            # threads rather than processes: map rendering runs in QGIS C++ code without holding the GIL,
+            # while map settings and layers cannot be shared with worker processes
+
+            # rendered metatiles are encoded and written by dedicated writer threads, so rendering threads
+            # don't wait for encoding, writers serialize access to shared resources (e.g. sqlite) themselves
+            self.tileQueue = queue.Queue(maxsize=2 * self.maxThreads)
+            writer_threads = [threading.Thread(target=self.writeQueuedTiles, name='TilesXYZWriter_{}'.format(i))
+                              for i in range(self.maxThreads)]
+            for writer_thread in writer_threads:
+                writer_thread.start()
+            try:
+                # a single pool for all zoom levels, so that its threads are not restarted for every zoom level
+                # and metatiles of the next zoom level are picked up as soon as a thread is free
                 with ThreadPoolExecutor(max_workers=self.maxThreads) as threadPool:
-                    for result in threadPool.map(self.renderSingleMetatile, metatiles_by_zoom[zoom]):
+                    # zoom levels overlap in the pool, so a zoom level is reported once its last metatile is rendered
+                    remaining = {zoom: get_metatiles_count(self.wgs_extent, zoom, self.metatilesize, tile_extent)
+                                 for zoom, tile_extent in self.tile_extents.items()}
+                    pending = {}
+
+                    def metatileRendered(future):
                         # re-raise exceptions from threads
-                        _ = result
+                        future.result()
+                        zoom = pending.pop(future)
+                        remaining[zoom] -= 1
+                        if remaining[zoom] == 0:
+                            feedback.pushConsoleInfo(self.tr('Rendered tiles for zoom level: {zoom}').format(zoom=zoom))
+
+                    for zoom in range(self.min_zoom, self.max_zoom + 1):
+                        feedback.pushConsoleInfo(self.tr('Queuing tiles for zoom level: {zoom}').format(zoom=zoom))
+                        for metatile in get_metatiles(self.wgs_extent, zoom, self.metatilesize, self.tile_extents[zoom]):
+                            # limit the number of submitted metatiles, rather than holding a future for all of them
+                            if len(pending) >= MAX_PENDING_METATILES * self.maxThreads:
+                                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                                for future in done:
+                                    metatileRendered(future)
+                            pending[threadPool.submit(self.renderSingleMetatile, metatile)] = zoom
+                    for future in as_completed(list(pending)):
+                        metatileRendered(future)
+            finally:
+                for _ in writer_threads:
+                    self.tileQueue.put(None)
+                for writer_thread in writer_threads:
+                    writer_thread.join()
+            if self.writerError is not None:
+                # re-raise exceptions from writer threads
+                raise self.writerError
         else:
             feedback.pushConsoleInfo(self.tr('Using 1 CPU Thread:'))
             for zoom in range(self.min_zoom, self.max_zoom + 1):
                 feedback.pushConsoleInfo(self.tr('Generating tiles for zoom level: {zoom}').format(zoom=zoom))
-                for i, metatile in enumerate(metatiles_by_zoom[zoom]):
+                for metatile in get_metatiles(self.wgs_extent, zoom, self.metatilesize, self.tile_extents[zoom]):
                     self.renderSingleMetatile(metatile)
 
-        writer.close()
-
     def checkParameterValues(self, parameters, context):
         min_zoom = self.parameterAsInt(parameters, self.ZOOM_MIN, context)
         max_zoom = self.parameterAsInt(parameters, self.ZOOM_MAX, context)
@@ -364,11 +505,17 @@ class TilesXYZAlgorithmBase(QgisAlgorithm):
 # MBTiles
 ########################################################################
 class MBTilesWriter:
+    # number of tiles inserted within a single transaction
+    BATCH_SIZE = 256
 
-    def __init__(self, filename):
+    def __init__(self, filename, fast_encoding=False):
         base_dir = os.path.dirname(filename)
         os.makedirs(base_dir, exist_ok=True)
         self.filename = filename
+        self.fast_encoding = fast_encoding
+        self._fast_encoder = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
 
     def set_parameters(self, tile_params):
         self.extent = tile_params.get('extent')
@@ -378,13 +525,24 @@ class MBTilesWriter:
         self.max_zoom = tile_params.get('max_zoom')
         tile_format = tile_params['format']
         options = []
+        self.quality = -1
         if tile_format == 'JPG':
             tile_format = 'JPEG'
-            options = ['QUALITY=%s' % tile_params.get('quality', 75)]
+            self.quality = tile_params.get('quality', 75)
+            options = ['QUALITY=%s' % self.quality]
+        self.format = tile_format
+        if self.fast_encoding:
+            self._fast_encoder = self._create_fast_encoder()
+        # GDAL only creates the MBTiles schema and metadata, tiles are inserted directly
         driver = gdal.GetDriverByName('MBTiles')
         ds = driver.Create(self.filename, 1, 1, 1, options=['TILE_FORMAT=%s' % tile_format] + options)
         ds = None
 
+        # wait_timeout = default timeout is 5 seconds increase it for slower disk access and more Threads to 120 seconds
+        # isolation_level = None Uses sqlite AutoCommit and disable phyton transaction management feature. https://docs.python.org/3/library/sqlite3.html#sqlite3-controlling-transactions
+        # check_same_thread = False the connection is shared by all threads, access to it is guarded by self._lock
+        self._conn = sqlite3.connect(self.filename, timeout=120, isolation_level=None, check_same_thread=False)
+
         # faster sqlite processing for parallel access https://stackoverflow.com/questions/15143871/simplest-way-to-retry-sqlite-query-if-db-is-locked
         self._execute_sqlite("PRAGMA journal_mode=WAL")
 
@@ -394,68 +552,119 @@ class MBTilesWriter:
             # will be set properly after writing all tiles
             "INSERT INTO metadata(name, value) VALUES ('{}', '');".format('bounds')
         )
-        self._zoom = None
+        self._pending_tiles = []
 
     def _execute_sqlite(self, *commands):
-        # wait_timeout = default timeout is 5 seconds increase it for slower disk access and more Threads to 120 seconds
-        # isolation_level = None Uses sqlite AutoCommit and disable phyton transaction management feature. https://docs.python.org/3/library/sqlite3.html#sqlite3-controlling-transactions
-        conn = sqlite3.connect(self.filename, timeout=120, isolation_level=None)
         for cmd in commands:
-            conn.execute(cmd)
-        conn.commit()
-        conn.close()
-
-    def _init_zoom_layer(self, zoom):
-        self._zoom_ds = None
-        west_edge, south_edge, east_edge, north_edge = self.extent
-        first_tile = Tile(*deg2num(north_edge, west_edge, zoom), zoom)
-        last_tile = Tile(*deg2num(south_edge, east_edge, zoom), zoom)
-
-        first_tile_extent = first_tile.extent()
-        last_tile_extent = last_tile.extent()
-        zoom_extent = [
-            first_tile_extent[0],
-            last_tile_extent[1],
-            last_tile_extent[2],
-            first_tile_extent[3]
-        ]
-
-        bounds = ','.join(map(str, zoom_extent))
-        self._execute_sqlite(f"UPDATE metadata SET value='{bounds}' WHERE name='bounds'")
-
-        self._zoom_ds = gdal.OpenEx(self.filename, 1, open_options=['ZOOM_LEVEL=%s' % first_tile.z])
-        self._first_tile = first_tile
-        self._zoom = zoom
-
-    def write_tile(self, tile, image):
-        if tile.z != self._zoom:
-            self._init_zoom_layer(tile.z)
-
-        data = QByteArray()
-        buff = QBuffer(data)
-        image.save(buff, 'PNG')
+            self._conn.execute(cmd)
 
-        mmap_name = '/vsimem/' + uuid4().hex
-        gdal.FileFromMemBuffer(mmap_name, data.data())
-        gdal_dataset = gdal.Open(mmap_name)
-        data = gdal_dataset.ReadRaster(0, 0, self.tile_width, self.tile_height)
-        gdal_dataset = None
-        gdal.Unlink(mmap_name)
+    def _flush_tiles(self):
+        if not self._pending_tiles:
+            return
+        self._conn.execute("BEGIN")
+        try:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO tiles(zoom_level, tile_column, tile_row, tile_data) VALUES (?, ?, ?, ?)",
+                self._pending_tiles)
+            self._conn.execute("COMMIT")
+        except Exception:
+            # leave no transaction open, later batches would fail to BEGIN otherwise
+            if self._conn.in_transaction:
+                self._conn.execute("ROLLBACK")
+            raise
+        finally:
+            self._pending_tiles = []
+
+    def _create_fast_encoder(self):
+        """
+        Returns a function encoding a tile image with libspng (PNG) or libjpeg-turbo (JPEG),
+        or None if the required Python libraries are not available.
+        """
+        try:
+            import numpy as np
+            if self.format == 'JPEG':
+                from turbojpeg import TurboJPEG, TJPF_RGBX
+                jpeg = TurboJPEG()
+            else:
+                import pyspng
+        except (ImportError, OSError, RuntimeError):
+            return None
+
+        def pixels(image, image_format):
+            # 32 bit formats have no padding at the end of scan lines
+            image = image.convertToFormat(image_format)
+            data = np.frombuffer(image.constBits().asstring(image.sizeInBytes()), dtype=np.uint8)
+            return data.reshape(image.height(), image.width(), 4)
+
+        if self.format == 'JPEG':
+            # converting the premultiplied image to RGBX matches the Qt JPEG encoder output
+            return lambda image: jpeg.encode(pixels(image, QImage.Format_RGBX8888), quality=self.quality, pixel_format=TJPF_RGBX)
+        # favor throughput over compression ratio
+        return lambda image: pyspng.encode(pixels(image, QImage.Format_RGBA8888), compress_level=1)
+
+    def uses_fast_encoder(self) -> bool:
+        return self._fast_encoder is not None
+
+    def _encode_tile(self, image) -> bytes:
+        if self._fast_encoder is not None:
+            return self._fast_encoder(image)
+
+        # every thread reuses its own encoding buffer, the reserved capacity (uncompressed tile size)
+        # is kept when the array is truncated, unlike with QByteArray.clear()
+        if not hasattr(self._local, 'buffer'):
+            self._local.data = QByteArray()
+            self._local.data.reserve(self.tile_width * self.tile_height * 4)
+            self._local.buffer = QBuffer(self._local.data)
+            self._local.buffer.open(QIODevice.WriteOnly)
+        self._local.data.resize(0)
+        self._local.buffer.seek(0)
+        image.save(self._local.buffer, self.format, self.quality)
+        return self._local.data.data()
+
+    def _is_transparent(self, image) -> bool:
+        """
+        Returns True if every pixel of the tile image is fully transparent.
+        """
+        if not image.hasAlphaChannel():
+            return False
+        if image.format() != QImage.Format_ARGB32_Premultiplied:
+            image = image.convertToFormat(QImage.Format_ARGB32_Premultiplied)
+        # premultiplied transparent pixels are all zero, so scan lines are compared as a whole
+        row_size = image.width() * 4
+        empty_row = bytes(row_size)
+        for y in range(image.height()):
+            if image.constScanLine(y).asstring(row_size) != empty_row:
+                return False
+        return True
 
-        xoff = (tile.x - self._first_tile.x) * self.tile_width
-        yoff = (tile.y - self._first_tile.y) * self.tile_height
-        self._zoom_ds.WriteRaster(xoff, yoff, self.tile_width, self.tile_height, data)
+    def write_tile(self, tile, image):
+        # like the GDAL MBTiles driver, empty tiles are not stored, clients show missing tiles as transparent
+        if self._is_transparent(image):
+            return
+        # MBTiles tile rows follow the TMS convention
+        row = (tile.z, tile.x, tms(tile.y, tile.z), self._encode_tile(image))
+        with self._lock:
+            self._pending_tiles.append(row)
+            if len(self._pending_tiles) >= self.BATCH_SIZE:
+                self._flush_tiles()
 
     def close(self):
-        self._zoom_ds = None
-        bounds = ','.join(map(str, self.extent))
-        self._execute_sqlite(f"UPDATE metadata SET value='{bounds}' WHERE name='bounds'")
-        # Set Journal Mode back to default
-        self._execute_sqlite("PRAGMA journal_mode=DELETE")
+        try:
+            with self._lock:
+                self._flush_tiles()
+            bounds = ','.join(map(str, self.extent))
+            self._execute_sqlite(f"UPDATE metadata SET value='{bounds}' WHERE name='bounds'")
+        finally:
+            try:
+                # Set Journal Mode back to default
+                self._execute_sqlite("PRAGMA journal_mode=DELETE")
+            finally:
+                self._conn.close()
 
 
 class TilesXYZAlgorithmMBTiles(TilesXYZAlgorithmBase):
     OUTPUT_FILE = 'OUTPUT_FILE'
+    FAST_ENCODING = 'FAST_ENCODING'
 
     def initAlgorithm(self, config=None):
         super().initAlgorithm()
@@ -463,6 +672,12 @@ class TilesXYZAlgorithmMBTiles(TilesXYZAlgorithmBase):
                                                                 self.tr('Output file (for MBTiles)'),
                                                                 self.tr('MBTiles files (*.mbtiles)'),
                                                                 optional=True))
+        fast_encoding_param = QgsProcessingParameterBoolean(self.FAST_ENCODING,
+                                                            self.tr('Use fast tile encoding (requires pyspng or PyTurboJPEG)'),
+                                                            defaultValue=False,
+                                                            optional=True)
+        fast_encoding_param.setFlags(fast_encoding_param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(fast_encoding_param)
 
     def name(self):
         return 'tilesxyzmbtiles'
@@ -484,8 +699,11 @@ class TilesXYZAlgorithmMBTiles(TilesXYZAlgorithmBase):
         if not output_file:
             raise QgsProcessingException(self.tr('You need to specify output filename.'))
 
-        writer = MBTilesWriter(output_file)
+        fast_encoding = self.parameterAsBoolean(parameters, self.FAST_ENCODING, context)
+        writer = MBTilesWriter(output_file, fast_encoding)
         self.generate(writer, parameters, context, feedback)
+        if fast_encoding and not writer.uses_fast_encoder():
+            feedback.pushInfo(self.tr('Fast tile encoding is not available (pyspng or PyTurboJPEG is not installed), tiles were encoded by Qt.'))
 
         results = {'OUTPUT_FILE': output_file}
         return results
@@ -550,17 +768,25 @@ class DirectoryWriter:
     def __init__(self, folder, is_tms):
         self.folder = folder
         self.is_tms = is_tms
+        # (z, x) pairs whose tile directory already exists
+        self._dirs = set()
+        # zoom level directory paths by zoom
+        self._zoom_dirs = {}
 
     def set_parameters(self, tile_params):
         self.format = tile_params.get('format', 'PNG')
         self.quality = tile_params.get('quality', -1)
 
     def write_tile(self, tile, image):
-        directory = os.path.join(self.folder, str(tile.z), str(tile.x))
-        os.makedirs(directory, exist_ok=True)
-        ytile = tile.y
-        if self.is_tms:
-            ytile = tms(ytile, tile.z)
+        zoom_dir = self._zoom_dirs.get(tile.z)
+        if zoom_dir is None:
+            zoom_dir = self._zoom_dirs[tile.z] = os.path.join(self.folder, str(tile.z))
+        directory = os.path.join(zoom_dir, str(tile.x))
+        dkey = (tile.z, tile.x)
+        if dkey not in self._dirs:
+            os.makedirs(directory, exist_ok=True)
+            self._dirs.add(dkey)
+        ytile = (1 << tile.z) - tile.y - 1 if self.is_tms else tile.y
         path = os.path.join(directory, f'{ytile}.{self.format.lower()}')
         image.save(path, self.format, self.quality)
         return path
@@ -0,0 +1,248 @@
+"""QGIS Unit tests for the Processing XYZ tiles algorithms.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+"""
+__author__ = 'The QGIS Project'
+__date__ = 'October 2026'
+__copyright__ = '(C) 2026, The QGIS Project'
+
+import os
+import shutil
+import sqlite3
+import tempfile
+from unittest import mock
+
+from osgeo import gdal
+from qgis.core import (QgsCoordinateReferenceSystem,
+                       QgsFeature,
+                       QgsFillSymbol,
+                       QgsGeometry,
+                       QgsProcessingContext,
+                       QgsProcessingException,
+                       QgsProject,
+                       QgsProperty,
+                       QgsSingleSymbolRenderer,
+                       QgsSymbolLayer,
+                       QgsVectorLayer)
+from qgis.PyQt.QtCore import Qt
+from qgis.PyQt.QtGui import QColor, QImage
+import unittest
+from qgis.testing import start_app, QgisTestCase
+import processing
+
+from processing.algs.qgis.TilesXYZ import (DirectoryWriter,
+                                           MBTilesWriter,
+                                           Tile,
+                                           get_tile_based_extent,
+                                           get_tile_based_extent_multi,
+                                           num2merc)
+
+start_app()
+
+
+class TestTileMath(QgisTestCase):
+
+    def testTileBasedExtentMulti(self):
+        """Test that get_tile_based_extent_multi matches get_tile_based_extent for every zoom level"""
+        extents = [
+            [-180.0, -85.0511287798066, 180.0, 85.0511287798066],
+            [14.2, 48.1, 14.3, 48.2],
+            [-73.99, 40.70, -73.95, 40.75],
+            [151.1, -33.95, 151.3, -33.8],
+            [-0.0001, -0.0001, 0.0001, 0.0001],
+        ]
+        zooms = range(0, 26)
+        for extent in extents:
+            tile_extents = get_tile_based_extent_multi(extent, zooms)
+            self.assertEqual(list(tile_extents.keys()), list(zooms))
+            for zoom in zooms:
+                self.assertEqual(tile_extents[zoom], get_tile_based_extent(extent, zoom), (extent, zoom))
+
+
+class TestMBTilesWriter(QgisTestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def testTilesReadByGdal(self):
+        """Test that tiles written by MBTilesWriter are read back by the GDAL MBTiles driver"""
+        filename = os.path.join(self.tmpdir, 'tiles.mbtiles')
+        writer = MBTilesWriter(filename)
+        writer.set_parameters({
+            'format': 'PNG',
+            'quality': 75,
+            'width': 256,
+            'height': 256,
+            'min_zoom': 1,
+            'max_zoom': 1,
+            'extent': [-180.0, -85.0511287798066, 180.0, 85.0511287798066],
+        })
+        # XYZ tile index -> fill color, every tile of zoom level 1 gets a different one
+        colors = {
+            (0, 0): QColor(255, 0, 0),
+            (1, 0): QColor(0, 255, 0),
+            (0, 1): QColor(0, 0, 255),
+            (1, 1): QColor(255, 255, 0),
+        }
+        for (x, y), color in colors.items():
+            image = QImage(256, 256, QImage.Format_ARGB32_Premultiplied)
+            image.fill(color)
+            writer.write_tile(Tile(x, y, 1), image)
+        writer.close()
+
+        ds = gdal.OpenEx(filename, open_options=['ZOOM_LEVEL=1'])
+        self.assertIsNotNone(ds)
+        self.assertEqual(ds.RasterCount, 4)
+        gt = ds.GetGeoTransform()
+        for (x, y), color in colors.items():
+            # read the pixel at the center of the tile
+            center_x, center_y = num2merc(x + 0.5, y + 0.5, 1)
+            col = int((center_x - gt[0]) / gt[1])
+            row = int((center_y - gt[3]) / gt[5])
+            pixel = [ds.GetRasterBand(band).ReadRaster(col, row, 1, 1)[0] for band in range(1, 5)]
+            self.assertEqual(pixel, [color.red(), color.green(), color.blue(), 255], (x, y))
+        ds = None
+
+    def testTransparentTilesSkipped(self):
+        """Test that fully transparent tiles are not stored, like with the GDAL MBTiles driver"""
+        filename = os.path.join(self.tmpdir, 'tiles.mbtiles')
+        writer = MBTilesWriter(filename)
+        writer.set_parameters({
+            'format': 'JPG',
+            'quality': 75,
+            'width': 256,
+            'height': 256,
+            'min_zoom': 1,
+            'max_zoom': 1,
+            'extent': [-180.0, -85.0511287798066, 180.0, 85.0511287798066],
+        })
+        transparent = QImage(256, 256, QImage.Format_ARGB32_Premultiplied)
+        transparent.fill(Qt.transparent)
+        writer.write_tile(Tile(0, 0, 1), transparent)
+        # a single visible pixel is enough for the tile to be stored
+        partial = QImage(256, 256, QImage.Format_ARGB32_Premultiplied)
+        partial.fill(Qt.transparent)
+        partial.setPixelColor(255, 255, QColor(255, 0, 0))
+        writer.write_tile(Tile(1, 0, 1), partial)
+        writer.close()
+
+        conn = sqlite3.connect(filename)
+        try:
+            stored = conn.execute('SELECT zoom_level, tile_column, tile_row FROM tiles').fetchall()
+        finally:
+            conn.close()
+        # tile rows follow the TMS convention
+        self.assertEqual(stored, [(1, 1, 1)])
+
+
+class TestTilesXYZAlgorithms(QgisTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        from processing.core.Processing import Processing
+        Processing.initialize()
+
+        # polygons of different colors covering part of the extent, the rest of the tiles stays empty
+        cls.layer = QgsVectorLayer('Polygon?crs=epsg:4326&field=color:string', 'polygons', 'memory')
+        features = []
+        for wkt, color in [('POLYGON((1 1, 9 1, 9 9, 1 9, 1 1))', '255,0,0'),
+                           ('POLYGON((6 4, 14 4, 14 12, 6 12, 6 4))', '0,128,255'),
+                           ('POLYGON((2 12, 8 18, 3 19, 2 12))', '40,200,40')]:
+            feature = QgsFeature(cls.layer.fields())
+            feature.setGeometry(QgsGeometry.fromWkt(wkt))
+            feature.setAttributes([color])
+            features.append(feature)
+        cls.layer.dataProvider().addFeatures(features)
+        symbol = QgsFillSymbol.createSimple({'outline_color': '0,0,0', 'outline_width': '0.6'})
+        symbol.symbolLayer(0).setDataDefinedProperty(QgsSymbolLayer.PropertyFillColor, QgsProperty.fromField('color'))
+        cls.layer.setRenderer(QgsSingleSymbolRenderer(symbol))
+
+        cls.project = QgsProject()
+        cls.project.setCrs(QgsCoordinateReferenceSystem('EPSG:4326'))
+        cls.project.addMapLayer(cls.layer)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.project = None
+        from processing.core.Processing import Processing
+        Processing.deinitialize()
+        super().tearDownClass()
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def runTilesAlgorithm(self, alg_id, threads, output_parameters):
+        context = QgsProcessingContext()
+        context.setProject(self.project)
+        context.setMaximumThreads(threads)
+        parameters = {
+            'EXTENT': '0,20,0,20 [EPSG:4326]',
+            'ZOOM_MIN': 3,
+            'ZOOM_MAX': 6,
+            'DPI': 96,
+            'ANTIALIAS': True,
+            'TILE_FORMAT': 0,  # PNG, lossless so that pixels can be compared
+            'QUALITY': 75,
+            # small metatiles, so that there are many of them including partial ones at the extent edges
+            'METATILESIZE': 2,
+        }
+        parameters.update(output_parameters)
+        return processing.run(alg_id, parameters, context=context)
+
+    def directoryTiles(self, threads):
+        output_dir = os.path.join(self.tmpdir, 'tiles_{}'.format(threads))
+        self.runTilesAlgorithm('qgis:tilesxyzdirectory', threads, {'OUTPUT_DIRECTORY': output_dir})
+        tiles = {}
+        for root, _, files in os.walk(output_dir):
+            for file in files:
+                path = os.path.join(root, file)
+                tiles[os.path.relpath(path, output_dir)] = QImage(path)
+        return tiles
+
+    def mbtilesTiles(self, threads):
+        output_file = os.path.join(self.tmpdir, 'tiles_{}.mbtiles'.format(threads))
+        self.runTilesAlgorithm('qgis:tilesxyzmbtiles', threads, {'OUTPUT_FILE': output_file})
+        conn = sqlite3.connect(output_file)
+        try:
+            rows = conn.execute('SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles').fetchall()
+        finally:
+            conn.close()
+        return {(z, x, y): QImage.fromData(data) for z, x, y, data in rows}
+
+    def assertSameTiles(self, single_thread_tiles, multi_thread_tiles):
+        self.assertTrue(single_thread_tiles)
+        self.assertEqual(sorted(multi_thread_tiles.keys()), sorted(single_thread_tiles.keys()))
+        for key, image in single_thread_tiles.items():
+            self.assertFalse(image.isNull(), key)
+            # a metatile image recycled before all of its tiles were written shows up as different pixels
+            self.assertTrue(multi_thread_tiles[key] == image, key)
+
+    def testDirectoryThreads(self):
+        """Test that tiles written to a directory by several threads are the same as with a single thread"""
+        self.assertSameTiles(self.directoryTiles(1), self.directoryTiles(4))
+
+    def testMBTilesThreads(self):
+        """Test that tiles written to MBTiles by several threads are the same as with a single thread"""
+        self.assertSameTiles(self.mbtilesTiles(1), self.mbtilesTiles(4))
+
+    def testWriterErrorRaised(self):
+        """Test that an exception raised while writing tiles fails the algorithm"""
+        for writer_class, alg_id, output_parameter, output_name in [
+                (DirectoryWriter, 'qgis:tilesxyzdirectory', 'OUTPUT_DIRECTORY', 'tiles_{}'),
+                (MBTilesWriter, 'qgis:tilesxyzmbtiles', 'OUTPUT_FILE', 'tiles_{}.mbtiles')]:
+            for threads in (1, 4):
+                output_parameters = {output_parameter: os.path.join(self.tmpdir, output_name.format(threads))}
+                with mock.patch.object(writer_class, 'write_tile', side_effect=OSError('tile write failure')) as write_tile:
+                    with self.assertRaises(QgsProcessingException, msg=(alg_id, threads)):
+                        self.runTilesAlgorithm(alg_id, threads, output_parameters)
+                self.assertTrue(write_tile.called, (alg_id, threads))
+
+
+if __name__ == '__main__':
+    unittest.main()